@@ -7,21 +7,26 @@
 # file you can find at the root of the distribution bundle.  If the file is
 # missing please request a copy by contacting info@glencoesoftware.com
 
-import json
+import io
 import math
 import os
+import queue
 
+import imagecodecs
+import numcodecs
 import numpy as np
+import orjson
 import pixelengine
 import softwarerendercontext
 import softwarerenderbackend
+import tifffile
 import zarr
 
-from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
-from threading import BoundedSemaphore
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from threading import BoundedSemaphore, Thread
 
 from PIL import Image
-from tifffile import imwrite
 
 
 class MaxQueuePool(object):
@@ -65,20 +70,170 @@ class MaxQueuePool(object):
         self.pool.__exit__(exception_type, exception_value, traceback)
 
 
+def make_planar(pixels, tile_width, tile_height):
+    '''deinterleave RGB pixels into a (3, height, width) planar array'''
+    return np.ascontiguousarray(
+        pixels.reshape(tile_height, tile_width, 3).transpose(2, 0, 1)
+    )
+
+
+def write_zarr_tile(
+    pixels, dataset, x_start, y_start, tile_width, tile_height, filename
+):
+    '''write a tile into an N5/Zarr dataset'''
+    # Special case for N5/Zarr which has a single n-dimensional
+    # array representation on disk
+    x_end = x_start + tile_width
+    y_end = y_start + tile_height
+    pixels = make_planar(pixels, tile_width, tile_height)
+    dataset[:, y_start:y_end, x_start:x_end] = pixels
+
+
+def write_tiff_tile(
+    pixels, dataset, x_start, y_start, tile_width, tile_height, filename
+):
+    '''write a tile into a memory-mapped TIFF image'''
+    # Special case for TIFF which is written in planar mode to a
+    # single memory-mapped file per resolution; planar data is much
+    # more performant with the Bio-Formats API
+    dataset[
+        :, y_start:y_start + tile_height, x_start:x_start + tile_width
+    ] = pixels.reshape(tile_height, tile_width, 3).transpose(2, 0, 1)
+
+
+def encode_jpeg_tile(
+    pixels, dataset, x_start, y_start, tile_width, tile_height, filename
+):
+    '''encode a tile as JPEG with imagecodecs'''
+    # JPEG quality matches the PIL default
+    pixels = pixels.reshape(tile_height, tile_width, 3)
+    return filename, imagecodecs.jpeg8_encode(pixels, level=75)
+
+
+def encode_png_tile(
+    pixels, dataset, x_start, y_start, tile_width, tile_height, filename
+):
+    '''encode a tile as PNG with imagecodecs'''
+    pixels = pixels.reshape(tile_height, tile_width, 3)
+    return filename, imagecodecs.png_encode(pixels)
+
+
+def encode_image_tile(
+    pixels, dataset, x_start, y_start, tile_width, tile_height, filename
+):
+    '''encode a tile with PIL in the format matching its file extension'''
+    extension = os.path.splitext(filename)[1]
+    with Image.frombuffer(
+        'RGB', (int(tile_width), int(tile_height)),
+        pixels, 'raw', 'RGB', 0, 1
+    ) as source, io.BytesIO() as destination:
+        source.save(destination, Image.registered_extensions()[extension])
+        return filename, destination.getvalue()
+
+
+def write_tile(
+    write_function, pixels, dataset, x_start, y_start, tile_width,
+    tile_height, filename
+):
+    '''write a single tile; runs on a tile worker thread or process
+
+    N5/Zarr and TIFF tiles are written directly into `dataset`.  All other
+    tiles are only encoded, and a `(filename, bytes)` tuple is returned for
+    the tile file writer to put on disk.
+    '''
+    try:
+        return write_function(
+            pixels, dataset, x_start, y_start, tile_width, tile_height,
+            filename
+        )
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        print(
+            "Failed to write tile [:, %d:%d, %d:%d] to %s" % (
+                x_start, x_start + tile_width, y_start,
+                y_start + tile_height, filename
+            )
+        )
+
+
+class TileFileWriter(object):
+    """Writes encoded tiles to disk from a single dedicated thread.
+
+    Tiles are queued as `(filename, bytes)` tuples by `queue_tile`, which is
+    used as a done callback of tile worker futures.  Entering the writer
+    starts its thread; exiting it waits for all queued tiles to be written.
+    """
+    def __init__(self, max_queue_size):
+        self.tile_queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = Thread(target=self.write_tiles)
+
+    def queue_tile(self, future):
+        """Queues the tile encoded by a completed future for writing."""
+        tile = future.result()
+        if tile is not None:
+            self.tile_queue.put(tile)
+
+    def write_tiles(self):
+        """Writes queued tiles to disk until None is received."""
+        while True:
+            tile = self.tile_queue.get()
+            if tile is None:
+                return
+            filename, encoded = tile
+            try:
+                with open(filename, 'wb') as destination:
+                    destination.write(encoded)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                print("Failed to write tile file %s" % filename)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.tile_queue.put(None)
+        self.thread.join()
+
+
 class WriteTiles(object):
 
     def __init__(
         self, tile_width, tile_height, resolutions, file_type, max_workers,
-        input_path, output_path
+        input_path, output_path, compression="lz4", clevel=5, shuffle="byte"
     ):
         self.tile_width = tile_width
         self.tile_height = tile_height
         self.resolutions = resolutions
         self.file_type = file_type
         self.max_workers = max_workers
+        self.compression = compression
+        self.clevel = clevel
+        shuffles = {
+            "none": numcodecs.Blosc.NOSHUFFLE,
+            "byte": numcodecs.Blosc.SHUFFLE,
+            "bit": numcodecs.Blosc.BITSHUFFLE,
+        }
+        if shuffle not in shuffles:
+            raise ValueError(
+                "Invalid shuffle %r; expected one of %s" % (
+                    shuffle, ", ".join(shuffles)
+                )
+            )
+        self.shuffle = shuffles[shuffle]
         self.input_path = input_path
         self.slide_directory = output_path
 
+        # Pool of reusable pixel buffers, each large enough to hold a full
+        # tile; edge tiles use a view over the start of a buffer
+        self.buffer_pool = queue.Queue()
+        for i in range(self.max_workers * 2):
+            self.buffer_pool.put(
+                np.empty(self.tile_width * self.tile_height * 3, dtype='B')
+            )
+
         os.mkdir(self.slide_directory)
 
         render_context = softwarerendercontext.SoftwareRenderContext()
@@ -99,7 +254,7 @@ class WriteTiles(object):
         '''write metadata to a JSON file'''
         pe_in = self.pixel_engine["in"]
         metadata_file = os.path.join(self.slide_directory, "METADATA.json")
-        with open(metadata_file, "w", encoding="utf-8") as f:
+        with open(metadata_file, "wb") as f:
             metadata = {
                 "Barcode":
                     pe_in.BARCODE,
@@ -178,7 +333,7 @@ class WriteTiles(object):
 
                 metadata["Image #" + str(image)] = image_metadata
 
-            json.dump(metadata, f)
+            f.write(orjson.dumps(metadata))
 
     def get_size(self, dim_range):
         '''calculate the length in pixels of a dimension'''
@@ -208,14 +363,26 @@ class WriteTiles(object):
             image_file = os.path.join(
                 self.slide_directory, '%s.jpg' % image_type
             )
-            with open(image_file, "wb") as image:
-                image.write(pixels)
+            # Write the image with unbuffered os.write() calls; a single
+            # write may be short, so continue until all bytes are written
+            pixels = memoryview(pixels)
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+            # O_BINARY is required on Windows to avoid newline translation
+            flags |= getattr(os, "O_BINARY", 0)
+            fd = os.open(image_file, flags, 0o644)
+            try:
+                while pixels:
+                    pixels = pixels[os.write(fd, pixels):]
+            finally:
+                os.close(fd)
             print("wrote %s image" % image_type)
 
     def create_tile_directory(self, resolution, width, height):
+        '''create the output location and dataset (if any) for a resolution'''
         tile_directory = os.path.join(
             self.slide_directory, str(resolution)
         )
+        dataset = None
         if self.file_type in ("n5", "zarr"):
             tile_directory = os.path.join(
                 self.slide_directory, "pyramid.%s" % self.file_type
@@ -223,32 +390,47 @@ class WriteTiles(object):
             store = zarr.DirectoryStore(tile_directory)
             if self.file_type == "n5":
                 store = zarr.N5Store(tile_directory)
-            group = zarr.group(store=store)
+            # the dataset is shared between the tile workers; the
+            # synchronizer allows writes to distinct chunks to proceed
+            # concurrently
+            group = zarr.group(
+                store=store, synchronizer=zarr.ThreadSynchronizer()
+            )
             dataset = group.create_dataset(
                 str(resolution), shape=(3, height, width),
-                chunks=(None, self.tile_height, self.tile_width), dtype='B'
+                chunks=(None, self.tile_height, self.tile_width), dtype='B',
+                compressor=numcodecs.Blosc(
+                    cname=self.compression, clevel=self.clevel,
+                    shuffle=self.shuffle
+                )
+            )
+        elif self.file_type == "tiff":
+            tile_directory = os.path.join(
+                self.slide_directory, "%s.tiff" % resolution
+            )
+            # uncompressed, untiled BigTIFF so that the image data is
+            # contiguous and can be memory-mapped; dirty pages are
+            # written back by the kernel as the tiles are filled in.
+            # Strips are one tile high so that readers are not faced with a
+            # single strip per plane covering the whole resolution.
+            dataset = tifffile.memmap(
+                tile_directory, shape=(3, height, width), dtype='B',
+                bigtiff=True, photometric='rgb', planarconfig='separate',
+                rowsperstrip=self.tile_height
             )
         else:
             os.mkdir(tile_directory)
-        return tile_directory
+        return tile_directory, dataset
 
     def get_tile_filename(self, tile_directory, x_start, y_start):
         filename = os.path.join(
             os.path.join(tile_directory, str(x_start)),
             "%s.%s" % (y_start, self.file_type)
         )
-        if self.file_type in ("n5", "zarr"):
+        if self.file_type in ("n5", "zarr", "tiff"):
             filename = tile_directory
         return filename
 
-    def make_planar(self, pixels, tile_width, tile_height):
-        r = pixels[0::3]
-        g = pixels[1::3]
-        b = pixels[2::3]
-        for v in (r, g, b):
-            v.shape = (tile_height, tile_width)
-        return np.array([r, g, b])
-
     def write_pyramid(self):
         '''write the slide's pyramid as a set of tiles'''
         pe_in = self.pixel_engine["in"]
@@ -263,40 +445,24 @@ class WriteTiles(object):
         else:
             resolutions = range(self.resolutions)
 
-        def write_tile(
-            pixels, resolution, x_start, y_start, tile_width, tile_height,
-            filename
-        ):
-            x_end = x_start + tile_width
-            y_end = y_start + tile_height
-            try:
-                if self.file_type in ("n5", "zarr"):
-                    # Special case for N5/Zarr which has a single n-dimensional
-                    # array representation on disk
-                    pixels = self.make_planar(pixels, tile_width, tile_height)
-                    z = zarr.open(filename)[str(resolution)]
-                    z[:, y_start:y_end, x_start:x_end] = pixels
-                elif self.file_type == 'tiff':
-                    # Special case for TIFF to save in planar mode using
-                    # deinterleaving and the tifffile library; planar data
-                    # is much more performant with the Bio-Formats API
-                    pixels = self.make_planar(pixels, tile_width, tile_height)
-                    with open(filename, 'wb') as destination:
-                        imwrite(destination, pixels, planarconfig='SEPARATE')
-                else:
-                    with Image.frombuffer(
-                        'RGB', (int(tile_width), int(tile_height)),
-                        pixels, 'raw', 'RGB', 0, 1
-                    ) as source, open(filename, 'wb') as destination:
-                        source.save(destination)
-            except Exception:
-                import traceback
-                traceback.print_exc()
-                print(
-                    "Failed to write tile [:, %d:%d, %d:%d] to %s" % (
-                        x_start, x_end, y_start, y_end, filename
-                    )
-                )
+        if self.file_type in ("n5", "zarr", "tiff"):
+            # N5/Zarr/TIFF tiles are written to a shared dataset and
+            # compression (if any) releases the GIL, so threads are
+            # sufficient
+            executor = ThreadPoolExecutor
+        else:
+            # Encoding individual tile files is CPU bound and holds the GIL
+            # for much of its run time, so use separate processes
+            executor = ProcessPoolExecutor
+
+        # choose the tile writer once rather than for every tile
+        write_function = {
+            "n5": write_zarr_tile,
+            "zarr": write_zarr_tile,
+            "tiff": write_tiff_tile,
+            "jpg": encode_jpeg_tile,
+            "png": encode_png_tile,
+        }.get(self.file_type, encode_image_tile)
 
         source_view = pe_in.SourceView()
         for resolution in resolutions:
@@ -314,7 +480,7 @@ class WriteTiles(object):
             print("# of Y tiles = %s" % y_tiles)
 
             # create one tile directory per resolution level if required
-            tile_directory = self.create_tile_directory(
+            tile_directory, dataset = self.create_tile_directory(
                 resolution, resolution_x_end + 1, resolution_y_end + 1
             )
 
@@ -328,66 +494,128 @@ class WriteTiles(object):
             envelopes = source_view.dataEnvelopes(resolution)
             regions = source_view.requestRegions(
                 patches, envelopes, True, [0, 0, 0])
-
-            jobs = ()
-            with MaxQueuePool(ThreadPoolExecutor, self.max_workers) as pool:
-                while regions:
-                    regions_ready = self.pixel_engine.waitAny(regions)
-                    for region_index, region in enumerate(regions_ready):
-                        view_range = region.range
-                        print("processing tile %s" % view_range)
-                        x_start, x_end, y_start, y_end, level = view_range
-                        width = int(1 + (x_end - x_start) / dim_ranges[0][1])
-                        height = int(1 + (y_end - y_start) / dim_ranges[1][1])
-                        pixel_buffer_size = width * height * 3
-                        pixels = np.empty(int(pixel_buffer_size), dtype='B')
-                        patch_id = patch_identifier[regions.index(region)]
-                        x_start, y_start = patch_id
-                        x_start *= self.tile_width
-                        y_start *= self.tile_height
-                        patch_identifier.remove(patch_id)
-
-                        region.get(pixels)
-                        regions.remove(region)
-
-                        filename = self.get_tile_filename(
-                            tile_directory, x_start, y_start
-                        )
-                        jobs = jobs + (pool.submit(
-                            write_tile, pixels, resolution,
-                            x_start, y_start, width, height,
-                            filename
-                        ),)
-            wait(jobs, return_when=ALL_COMPLETED)
+            # Record the position of each region as requested so completed
+            # regions can be matched to their patch identifier without
+            # comparing regions; outstanding regions are kept in request
+            # order keyed by identity so they can be retired in constant time
+            positions = {
+                id(region): position for position, region in enumerate(regions)
+            }
+            pending = {id(region): region for region in regions}
+
+            # bind values used for every tile to locals
+            scale_x = dim_ranges[0][1]
+            scale_y = dim_ranges[1][1]
+            tile_width = self.tile_width
+            tile_height = self.tile_height
+            buffer_pool = self.buffer_pool
+            wait_any = self.pixel_engine.waitAny
+
+            with ExitStack() as stack:
+                # Encoded tile files are written by a single dedicated thread
+                # so that tile workers can move straight on to encoding the
+                # next tile.  The writer is entered first so that it is only
+                # stopped once the pool has shut down and every tile has been
+                # queued, including when an error occurs.
+                if executor is ProcessPoolExecutor:
+                    tile_writer = stack.enter_context(
+                        TileFileWriter(self.max_workers * 4)
+                    )
+                # Futures are not kept; exiting the pool waits for all tiles
+                pool = stack.enter_context(
+                    MaxQueuePool(executor, self.max_workers)
+                )
+                while pending:
+                    regions_ready = wait_any(list(pending.values()))
+                    # Copy the pixels of a batch of ready regions out of
+                    # the pixel engine before handing any of them to the
+                    # tile workers; batches are no larger than half the
+                    # buffer pool so that free buffers are always available
+                    batch_size = self.max_workers
+                    for batch_start in range(
+                        0, len(regions_ready), batch_size
+                    ):
+                        tiles = []
+                        for region in regions_ready[
+                            batch_start:batch_start + batch_size
+                        ]:
+                            view_range = region.range
+                            print("processing tile %s" % view_range)
+                            x_start, x_end, y_start, y_end, level = view_range
+                            width = int(1 + (x_end - x_start) / scale_x)
+                            height = int(1 + (y_end - y_start) / scale_y)
+                            pixel_buffer_size = width * height * 3
+                            buffer = buffer_pool.get()
+                            pixels = buffer[:pixel_buffer_size]
+                            position = positions[id(region)]
+                            x_start, y_start = patch_identifier[position]
+                            x_start *= tile_width
+                            y_start *= tile_height
+
+                            region.get(pixels)
+                            del pending[id(region)]
+                            tiles.append((
+                                buffer, pixels, x_start, y_start, width, height
+                            ))
+
+                        for tile in tiles:
+                            buffer, pixels, x_start, y_start, width, height = \
+                                tile
+                            filename = self.get_tile_filename(
+                                tile_directory, x_start, y_start
+                            )
+                            job = pool.submit(
+                                write_tile, write_function, pixels, dataset,
+                                x_start, y_start, width, height,
+                                filename
+                            )
+                            # return the buffer to the pool once the tile has
+                            # been written (or handed off to a worker process)
+                            job.add_done_callback(
+                                lambda _, buffer=buffer:
+                                    buffer_pool.put(buffer)
+                            )
+                            if executor is ProcessPoolExecutor:
+                                job.add_done_callback(tile_writer.queue_tile)
+            if self.file_type == "tiff":
+                dataset.flush()
+                del dataset
 
     def create_x_directory(self, tile_directory, x_start):
-        if self.file_type in ("n5", "zarr"):
+        if self.file_type in ("n5", "zarr", "tiff"):
             return
 
         x_directory = os.path.join(tile_directory, str(x_start))
-        if not os.path.exists(x_directory):
-            os.mkdir(x_directory)
+        os.makedirs(x_directory, exist_ok=True)
 
     def create_patch_list(
         self, image_x_end, image_y_end, tiles, tile_size, origin, level,
         tile_directory
     ):
-        patches = []
-        patch_identifier = []
         scale = 2 ** level
         tile_size[0] = tile_size[0] * scale
         tile_size[1] = tile_size[1] * scale
-        for y in range(tiles[1]):
-            y_start = origin[1] + (y * tile_size[1])
-            y_end = min((y_start + tile_size[1]) - scale, image_y_end)
-            for x in range(tiles[0]):
-                x_start = origin[0] + (x * tile_size[0])
-                x_end = min((x_start + tile_size[0]) - scale, image_x_end)
-                patch = [x_start, x_end, y_start, y_end, level]
-                patches.append(patch)
-                # Associating spatial information (tile X and Y offset) in
-                # order to identify the patches returned asynchronously
-                patch_identifier.append((x, y))
-
-                self.create_x_directory(tile_directory, x * self.tile_width)
+        # One directory per tile column, created up front rather than once
+        # per tile
+        for x in range(tiles[0]):
+            self.create_x_directory(tile_directory, x * self.tile_width)
+
+        # Patches are ordered row by row; compute their bounds for all
+        # tiles at once
+        x, y = np.meshgrid(
+            np.arange(tiles[0], dtype=np.int64),
+            np.arange(tiles[1], dtype=np.int64)
+        )
+        x = x.ravel()
+        y = y.ravel()
+        x_start = origin[0] + (x * tile_size[0])
+        x_end = np.minimum((x_start + tile_size[0]) - scale, image_x_end)
+        y_start = origin[1] + (y * tile_size[1])
+        y_end = np.minimum((y_start + tile_size[1]) - scale, image_y_end)
+        patches = np.stack(
+            [x_start, x_end, y_start, y_end, np.full_like(x, level)], axis=1
+        ).tolist()
+        # Associating spatial information (tile X and Y offset) in
+        # order to identify the patches returned asynchronously
+        patch_identifier = list(zip(x.tolist(), y.tolist()))
         return patches, patch_identifier
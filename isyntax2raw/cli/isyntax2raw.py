@@ -8,6 +8,7 @@
 # support@glencoesoftware.com.
 
 import click
+import numcodecs
 import psutil
 
 from .. import WriteTiles
@@ -40,15 +41,30 @@ def cli():
     show_default=True,
     help="maximum number of tile workers that will run at one time",
 )
+@click.option(
+    "--compression", default="lz4", show_default=True,
+    type=click.Choice(numcodecs.blosc.list_compressors()),
+    help="N5/Zarr Blosc compressor"
+)
+@click.option(
+    "--clevel", default=5, type=click.IntRange(0, 9), show_default=True,
+    help="N5/Zarr Blosc compression level"
+)
+@click.option(
+    "--shuffle", default="byte", show_default=True,
+    type=click.Choice(["none", "byte", "bit"]),
+    help="N5/Zarr Blosc shuffle applied before compression"
+)
 @click.argument("input_path")
 @click.argument("output_path")
 def write_tiles(
-    tile_width, tile_height, resolutions, file_type, max_workers, input_path,
-    output_path
+    tile_width, tile_height, resolutions, file_type, max_workers,
+    compression, clevel, shuffle, input_path, output_path
 ):
     with WriteTiles(
         tile_width, tile_height, resolutions, file_type, max_workers,
-        input_path, output_path
+        input_path, output_path, compression=compression, clevel=clevel,
+        shuffle=shuffle
     ) as wt:
         wt.write_metadata()
         wt.write_label_image()
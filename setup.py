@@ -85,6 +85,8 @@ setup(name='isyntax2raw',
           'tifffile==2019.7.26',
           'zarr @ git+git://github.com/zarr-developers/zarr-python.git@e6667aa',
           'numcodecs==0.6.3',
+          'imagecodecs==2019.12.31',
+          'orjson==2.1.3',
       ],
       tests_require=[
           'flake8',